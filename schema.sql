@@ -34,6 +34,9 @@ CREATE TABLE IF NOT EXISTS rechtspraak_uitspraken (
     -- Source URL for later full-text retrieval
     content_url String,
 
+    -- MinIO object path of the raw XML (NULL until stored)
+    xml_path Nullable(String),
+
     -- Related cases
     related_eclis Array(String),
 
@@ -48,3 +51,21 @@ SELECT e.ecli, e.last_modified, e.source_url
 FROM rechtspraak_eclis e
 LEFT JOIN rechtspraak_uitspraken u ON e.ecli = u.ecli
 WHERE u.ecli IS NULL;
+
+-- View: uitspraken without stored XML (backfill queue), latest version per ECLI
+CREATE VIEW IF NOT EXISTS rechtspraak_needs_xml AS
+SELECT
+    ecli,
+    argMax(case_number, scraped_at) AS case_number,
+    argMax(decision_date, scraped_at) AS decision_date,
+    argMax(publication_date, scraped_at) AS publication_date,
+    argMax(court, scraped_at) AS court,
+    argMax(court_type, scraped_at) AS court_type,
+    argMax(procedure_type, scraped_at) AS procedure_type,
+    argMax(subject_area, scraped_at) AS subject_area,
+    argMax(summary, scraped_at) AS summary,
+    argMax(content_url, scraped_at) AS content_url,
+    argMax(related_eclis, scraped_at) AS related_eclis
+FROM rechtspraak_uitspraken
+GROUP BY ecli
+HAVING countIf(xml_path IS NOT NULL) = 0;
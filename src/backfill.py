@@ -1,114 +1,143 @@
 """Backfill XML files for existing rechtspraak records.
 
-Downloads XML for records where xml_path IS NULL and stores in MinIO.
+Downloads XML for records without an xml_path (rechtspraak_needs_xml view)
+and stores in MinIO.
 Inserts new rows (ReplacingMergeTree will deduplicate by ecli).
 """
 
+import asyncio
 import httpx
-import clickhouse_connect
-import json
 import os
-import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from io import BytesIO
 
+import urllib3
+import zstandard
 from minio import Minio
+from minio.error import S3Error
+
+from . import common
+from .batcher import Batcher
+from .common import (
+    CONTENT_URL,
+    MINIO_BUCKET,
+    MINIO_PUT_WORKERS,
+    UITSPRAKEN_COLUMNS,
+    ZSTD_LEVEL,
+    ecli_to_path,
+    get_async_http_client,
+    get_clickhouse,
+    get_minio,
+)
+from .ratelimit import RateLimiter
 
 
 # Configuration
-CONTENT_URL = "https://data.rechtspraak.nl/uitspraken/content"
 REQUEST_DELAY = float(os.environ.get("REQUEST_DELAY", "1.0"))
 BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "100"))
-USER_AGENT = "OpenDataCollection.com bot - Data zonder drempels (https://opendatacollection.com)"
-
-# MinIO configuration
-MINIO_ENDPOINT = os.environ.get("MINIO_ENDPOINT", "localhost:9002")
-MINIO_ACCESS_KEY = os.environ.get("MINIO_ACCESS_KEY", "minioadmin")
-MINIO_SECRET_KEY = os.environ.get("MINIO_SECRET_KEY", "minioadmin")
-MINIO_BUCKET = os.environ.get("MINIO_BUCKET", "raw-data")
-MINIO_SECURE = os.environ.get("MINIO_SECURE", "false").lower() == "true"
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", "4"))
+
+# Same as in schema.sql, which only runs when the ClickHouse volume is first
+# initialised; created at startup so existing deployments get the view too
+NEEDS_XML_VIEW = """
+CREATE VIEW IF NOT EXISTS rechtspraak_needs_xml AS
+SELECT
+    ecli,
+    argMax(case_number, scraped_at) AS case_number,
+    argMax(decision_date, scraped_at) AS decision_date,
+    argMax(publication_date, scraped_at) AS publication_date,
+    argMax(court, scraped_at) AS court,
+    argMax(court_type, scraped_at) AS court_type,
+    argMax(procedure_type, scraped_at) AS procedure_type,
+    argMax(subject_area, scraped_at) AS subject_area,
+    argMax(summary, scraped_at) AS summary,
+    argMax(content_url, scraped_at) AS content_url,
+    argMax(related_eclis, scraped_at) AS related_eclis
+FROM rechtspraak_uitspraken
+GROUP BY ecli
+HAVING countIf(xml_path IS NOT NULL) = 0
+"""
 
 
 def log(level: str, message: str, **extra):
-    """Structured JSON logging."""
-    entry = {
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "level": level,
-        "message": message,
-        "script": "backfill",
-        **extra,
-    }
-    print(json.dumps(entry), file=sys.stderr if level == "ERROR" else sys.stdout)
-
-
-def get_clickhouse():
-    """Get ClickHouse client."""
-    return clickhouse_connect.get_client(
-        host=os.environ.get("CLICKHOUSE_HOST", "localhost"),
-        port=int(os.environ.get("CLICKHOUSE_PORT", "8123")),
-        username=os.environ.get("CLICKHOUSE_USER", "default"),
-        password=os.environ.get("CLICKHOUSE_PASSWORD", ""),
-    )
-
-
-def get_minio():
-    """Get MinIO client."""
-    client = Minio(
-        MINIO_ENDPOINT,
-        access_key=MINIO_ACCESS_KEY,
-        secret_key=MINIO_SECRET_KEY,
-        secure=MINIO_SECURE,
-    )
-
-    if not client.bucket_exists(MINIO_BUCKET):
-        client.make_bucket(MINIO_BUCKET)
-        log("INFO", "Created MinIO bucket", bucket=MINIO_BUCKET)
-
-    return client
-
-
-def get_http_client() -> httpx.Client:
-    """Get HTTP client with proper headers."""
-    return httpx.Client(
-        timeout=30.0,
-        headers={"User-Agent": USER_AGENT},
-    )
-
-
-def ecli_to_path(ecli: str) -> str:
-    """Convert ECLI to MinIO path."""
-    parts = ecli.split(":")
-    if len(parts) >= 5:
-        country = parts[1]
-        court = parts[2]
-        year = parts[3]
-        safe_ecli = ecli.replace(":", "_")
-        return f"rechtspraak/{country}/{court}/{year}/{safe_ecli}.xml"
-    else:
-        safe_ecli = ecli.replace(":", "_")
-        return f"rechtspraak/other/{safe_ecli}.xml"
-
-
-def download_and_store_xml(minio_client: Minio, ecli: str) -> str | None:
-    """Download XML and store in MinIO. Returns path or None on failure."""
-    url = f"{CONTENT_URL}?id={ecli}"
+    """Structured JSON logging, tagged with this script."""
+    common.log(level, message, script="backfill", **extra)
+
+
+def list_stored_objects(minio_client: Minio, directory: str) -> set[str]:
+    """List the object names stored under a MinIO directory prefix.
 
+    A failed listing is logged and treated as an empty directory, so its
+    ECLIs are downloaded again rather than aborting the backfill.
+    """
     try:
-        with get_http_client() as client:
-            resp = client.get(url)
-            resp.raise_for_status()
-            xml_content = resp.content
+        objects = minio_client.list_objects(MINIO_BUCKET, prefix=f"{directory}/", recursive=True)
+        return {obj.object_name for obj in objects}
+    except (S3Error, urllib3.exceptions.HTTPError) as e:
+        log("ERROR", "Failed to list stored XML", directory=directory, error=str(e))
+        return set()
+
+
+def find_stored_path(stored: dict[str, set[str]], ecli: str) -> str | None:
+    """Return the MinIO path already holding this ECLI's XML, if any.
+
+    stored maps directory prefix -> object names in it. Objects written before
+    compression was introduced have no .zst suffix.
+    """
+    path = ecli_to_path(ecli)
+    names = stored[path.rsplit("/", 1)[0]]
+    for candidate in (path + ".zst", path):
+        if candidate in names:
+            return candidate
+    return None
+
+
+# Blocking MinIO calls (uploads, listings) run here so they overlap the next fetches
+_PUT_POOL = ThreadPoolExecutor(max_workers=MINIO_PUT_WORKERS, thread_name_prefix="minio-put")
+
+
+async def download_and_store_xml(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    limiter: RateLimiter,
+    minio_client: Minio,
+    ecli: str,
+) -> str | None:
+    """Download XML and store it zstd-compressed in MinIO. Returns path or None on failure.
+
+    The decoded body is compressed chunk by chunk as it streams in, so only
+    the compressed document is ever held in memory. The XML size is not known
+    up front, so the frame does not record it; read these objects with
+    streaming decompression (see CLAUDE.md).
+    """
+    url = f"{CONTENT_URL}?id={ecli}"
 
-            path = ecli_to_path(ecli)
-            minio_client.put_object(
+    try:
+        chunks = []
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        async with sem:
+            await limiter.acquire()
+            async with client.stream("GET", url) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes(65536):
+                    chunks.append(compressor.compress(chunk))
+        chunks.append(compressor.flush())
+        compressed = b"".join(chunks)
+
+        path = ecli_to_path(ecli) + ".zst"
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            _PUT_POOL,
+            lambda: minio_client.put_object(
                 MINIO_BUCKET,
                 path,
-                BytesIO(xml_content),
-                len(xml_content),
-                content_type="application/xml",
-            )
-            return path
+                BytesIO(compressed),
+                len(compressed),
+                content_type="application/zstd",
+            ),
+        )
+        return path
 
     except Exception as e:
         log("ERROR", "Failed to download/store XML", ecli=ecli, error=str(e))
@@ -117,82 +146,141 @@ def download_and_store_xml(minio_client: Minio, ecli: str) -> str | None:
 
 def main():
     """Main backfill process."""
-    log("INFO", "Starting XML backfill")
+    log("INFO", "Starting XML backfill", concurrency=FETCH_CONCURRENCY)
+    asyncio.run(_backfill())
+
 
+async def _backfill():
+    """Download missing XML batch by batch, with concurrent downloads within a batch."""
     ch = get_clickhouse()
     minio = get_minio()
+    loop = asyncio.get_running_loop()
+
+    ch.command(NEEDS_XML_VIEW)
 
     # Count total to backfill
-    total = ch.query("SELECT count() FROM rechtspraak_uitspraken WHERE xml_path IS NULL")
+    total = ch.query("SELECT count() FROM rechtspraak_needs_xml")
     total_count = total.result_rows[0][0]
     log("INFO", f"Records to backfill", count=total_count)
 
     processed = 0
     success = 0
     failed = 0
-
-    while True:
-        # Get batch of records without xml_path
-        # Use FINAL to get deduplicated view
-        batch = ch.query(f"""
-            SELECT
-                ecli, case_number, decision_date, publication_date,
-                court, court_type, procedure_type, subject_area,
-                summary, content_url, related_eclis
-            FROM rechtspraak_uitspraken FINAL
-            WHERE xml_path IS NULL
-            LIMIT {BATCH_SIZE}
-        """)
-
-        if not batch.result_rows:
-            log("INFO", "No more records to backfill")
-            break
-
-        log("INFO", f"Processing batch", count=len(batch.result_rows), progress=f"{processed}/{total_count}")
-
-        rows_to_insert = []
-        for row in batch.result_rows:
-            ecli = row[0]
-            xml_path = download_and_store_xml(minio, ecli)
-            time.sleep(REQUEST_DELAY)
-
-            if xml_path:
-                # Create new row with xml_path filled in
-                rows_to_insert.append((
-                    row[0],   # ecli
-                    row[1],   # case_number
-                    row[2],   # decision_date
-                    row[3],   # publication_date
-                    row[4],   # court
-                    row[5],   # court_type
-                    row[6],   # procedure_type
-                    row[7],   # subject_area
-                    row[8],   # summary
-                    row[9],   # content_url
-                    row[10],  # related_eclis
-                    datetime.now(timezone.utc),  # scraped_at (new timestamp)
-                    xml_path,  # xml_path (now filled)
+    already_stored = 0
+
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    limiter = RateLimiter(1.0 / REQUEST_DELAY if REQUEST_DELAY > 0 else float("inf"))
+
+    uitspraken = Batcher(ch, "rechtspraak_uitspraken", UITSPRAKEN_COLUMNS)
+
+    # Page by key: buffered (not yet inserted) and failed records still have
+    # xml_path NULL and must not be selected again
+    last_ecli = ""
+
+    # Object listings per court/year directory, so XML stored by an earlier,
+    # interrupted run is not downloaded again. Batches arrive in ecli order,
+    # so only the directories of the current batch are kept.
+    stored = {}
+
+    async with get_async_http_client() as http_client:
+        with uitspraken:
+            while True:
+                # Find the key range of the next batch first. This reads the base
+                # table in ecli order and stops after BATCH_SIZE rows; a LIMIT on
+                # the view itself would aggregate every row after the cursor
+                upper = ch.query(
+                    """
+                    SELECT max(ecli) FROM (
+                        SELECT ecli FROM rechtspraak_uitspraken
+                        WHERE ecli > {after:String} AND xml_path IS NULL
+                        ORDER BY ecli
+                        LIMIT {batch:UInt32}
+                    )
+                    """,
+                    parameters={"after": last_ecli, "batch": BATCH_SIZE},
+                ).result_rows[0][0]
+
+                if not upper:
+                    log("INFO", "No more records to backfill")
+                    break
+
+                # Get batch of records without xml_path. The view groups by ecli,
+                # the sorting key, so the window prunes by primary key and the
+                # aggregation streams through it in order
+                batch = ch.query(
+                    """
+                    SELECT
+                        ecli, case_number, decision_date, publication_date,
+                        court, court_type, procedure_type, subject_area,
+                        summary, content_url, related_eclis
+                    FROM rechtspraak_needs_xml
+                    WHERE ecli > {after:String} AND ecli <= {upper:String}
+                    ORDER BY ecli
+                    SETTINGS optimize_aggregation_in_order = 1
+                    """,
+                    parameters={"after": last_ecli, "upper": upper},
+                )
+
+                last_ecli = upper
+                if not batch.result_rows:
+                    # Every candidate in the window already has XML in a newer row
+                    continue
+
+                log("INFO", f"Processing batch", count=len(batch.result_rows), progress=f"{processed}/{total_count}")
+
+                # Listings are blocking calls, so run them next to the uploads
+                directories = {ecli_to_path(row[0]).rsplit("/", 1)[0] for row in batch.result_rows}
+                new_directories = [d for d in directories if d not in stored]
+                listings = await asyncio.gather(*(
+                    loop.run_in_executor(_PUT_POOL, list_stored_objects, minio, d) for d in new_directories
                 ))
-                success += 1
-            else:
-                failed += 1
-
-            processed += 1
-
-        # Insert new rows (ReplacingMergeTree will dedupe by ecli, keeping newest scraped_at)
-        if rows_to_insert:
-            ch.insert(
-                "rechtspraak_uitspraken",
-                rows_to_insert,
-                column_names=[
-                    "ecli", "case_number", "decision_date", "publication_date",
-                    "court", "court_type", "procedure_type", "subject_area",
-                    "summary", "content_url", "related_eclis", "scraped_at", "xml_path",
-                ],
-            )
-            log("INFO", f"Inserted batch", count=len(rows_to_insert))
-
-    log("INFO", "Backfill complete", processed=processed, success=success, failed=failed)
+                stored = {d: stored[d] for d in directories if d in stored}
+                stored.update(zip(new_directories, listings))
+
+                existing = [find_stored_path(stored, row[0]) for row in batch.result_rows]
+                already_stored += sum(1 for path in existing if path)
+
+                downloaded = iter(await asyncio.gather(*(
+                    download_and_store_xml(http_client, sem, limiter, minio, row[0])
+                    for row, path in zip(batch.result_rows, existing)
+                    if path is None
+                )))
+                paths = [path or next(downloaded) for path in existing]
+
+                # One timestamp per batch is enough for ReplacingMergeTree to keep these rows
+                scraped_at = datetime.now(timezone.utc)
+
+                for row, xml_path in zip(batch.result_rows, paths):
+                    if xml_path:
+                        # Create new row with xml_path filled in
+                        uitspraken.append((
+                            row[0],   # ecli
+                            row[1],   # case_number
+                            row[2],   # decision_date
+                            row[3],   # publication_date
+                            row[4],   # court
+                            row[5],   # court_type
+                            row[6],   # procedure_type
+                            row[7],   # subject_area
+                            row[8],   # summary
+                            row[9],   # content_url
+                            xml_path,  # xml_path (now filled)
+                            row[10],  # related_eclis
+                            scraped_at,  # scraped_at (new timestamp)
+                        ))
+                        success += 1
+                    else:
+                        failed += 1
+
+                    processed += 1
+
+                # Insert new rows (ReplacingMergeTree will dedupe by ecli, keeping newest scraped_at)
+                flushed = uitspraken.maybe_flush()
+                if flushed:
+                    log("INFO", f"Inserted batch", count=flushed)
+
+    log("INFO", "Backfill complete", processed=processed, success=success, failed=failed,
+        already_stored=already_stored)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+"""Buffered ClickHouse inserts.
+
+Collects rows in memory and writes them in a few large INSERTs instead of
+one small INSERT per fetch batch, which keeps the number of MergeTree parts
+(and merge work) down.
+"""
+
+import os
+import time
+
+
+FLUSH_ROWS = int(os.environ.get("FLUSH_ROWS", "10000"))
+FLUSH_SECONDS = float(os.environ.get("FLUSH_SECONDS", "60"))
+
+# Let the server coalesce inserts further instead of creating a part per INSERT.
+# Wait for the server-side flush: with wait_for_async_insert=0 an INSERT only
+# means the data reached the server's buffer, and a failed flush would go
+# unnoticed (it only shows up in system.asynchronous_insert_log)
+ASYNC_INSERT_SETTINGS = {
+    "async_insert": 1,
+    "wait_for_async_insert": 1,
+    "async_insert_max_data_size": 10_000_000,
+}
+
+
+class Batcher:
+    """Buffer rows for one table and insert them in large batches.
+
+    Rows are kept column-oriented (one list per column) and sent with the
+    column types given, so the driver neither transposes rows nor has to
+    DESCRIBE the table before each insert.
+
+    A flush happens once flush_rows rows are buffered or flush_seconds have
+    passed since the previous flush, whichever comes first. Use as a context
+    manager (or call close()) so the remainder is written at the end.
+    """
+
+    def __init__(self, client, table: str, columns: dict[str, str],
+                 flush_rows: int = FLUSH_ROWS, flush_seconds: float = FLUSH_SECONDS,
+                 settings: dict = ASYNC_INSERT_SETTINGS):
+        """columns maps column name to ClickHouse type name, in insert order."""
+        self.client = client
+        self.table = table
+        self.column_names = list(columns)
+        self.column_type_names = list(columns.values())
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.settings = settings
+        self.columns = {name: [] for name in self.column_names}
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def append(self, row: tuple):
+        """Buffer one row given as a tuple in column order."""
+        for column, value in zip(self.columns.values(), row):
+            column.append(value)
+        self.size += 1
+
+    def extend_columns(self, columns: dict[str, list]):
+        """Buffer many rows given as equally long lists per column name."""
+        count = len(next(iter(columns.values())))
+        for name, values in columns.items():
+            self.columns[name].extend(values)
+        self.size += count
+
+    def maybe_flush(self) -> int:
+        """Flush if the row or time threshold is reached. Returns rows written."""
+        if self.size >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+            return self.flush()
+        return 0
+
+    def flush(self) -> int:
+        """Insert all buffered rows. Returns rows written."""
+        self.last_flush = time.monotonic()
+        if not self.size:
+            return 0
+
+        self.client.insert(
+            self.table,
+            list(self.columns.values()),
+            column_names=self.column_names,
+            column_type_names=self.column_type_names,
+            column_oriented=True,
+            settings=self.settings,
+        )
+        count = self.size
+        self.columns = {name: [] for name in self.column_names}
+        self.size = 0
+        return count
+
+    def close(self) -> int:
+        return self.flush()
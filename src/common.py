@@ -0,0 +1,123 @@
+"""Configuration, clients and helpers shared by the scraper and the backfill."""
+
+import atexit
+import functools
+import os
+import sys
+from datetime import datetime, timezone
+
+import certifi
+import clickhouse_connect
+import httpx
+import orjson
+import urllib3
+from minio import Minio
+
+
+CONTENT_URL = "https://data.rechtspraak.nl/uitspraken/content"
+USER_AGENT = "OpenDataCollection.com bot - Data zonder drempels (https://opendatacollection.com)"
+
+# MinIO configuration
+MINIO_ENDPOINT = os.environ.get("MINIO_ENDPOINT", "localhost:9002")
+MINIO_ACCESS_KEY = os.environ.get("MINIO_ACCESS_KEY", "minioadmin")
+MINIO_SECRET_KEY = os.environ.get("MINIO_SECRET_KEY", "minioadmin")
+MINIO_BUCKET = os.environ.get("MINIO_BUCKET", "raw-data")
+MINIO_SECURE = os.environ.get("MINIO_SECURE", "false").lower() == "true"
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", "10"))
+MINIO_PUT_WORKERS = int(os.environ.get("MINIO_PUT_WORKERS", "16"))
+
+# Column types of rechtspraak_uitspraken as in schema.sql, in insert order
+UITSPRAKEN_COLUMNS = {
+    "ecli": "String",
+    "case_number": "Nullable(String)",
+    "decision_date": "Nullable(Date)",
+    "publication_date": "Nullable(Date)",
+    "court": "String",
+    "court_type": "LowCardinality(String)",
+    "procedure_type": "LowCardinality(Nullable(String))",
+    "subject_area": "LowCardinality(Nullable(String))",
+    "summary": "Nullable(String)",
+    "content_url": "String",
+    "xml_path": "Nullable(String)",
+    "related_eclis": "Array(String)",
+    "scraped_at": "DateTime",
+}
+
+
+def log(level: str, message: str, **extra):
+    """Structured JSON logging."""
+    entry = {
+        "timestamp": datetime.now(timezone.utc),
+        "level": level,
+        "message": message,
+        "project": os.environ.get("PROJECT_NAME", "rechtspraak-scraper"),
+        **extra,
+    }
+    stream = sys.stderr if level == "ERROR" else sys.stdout
+    stream.buffer.write(orjson.dumps(entry, option=orjson.OPT_UTC_Z | orjson.OPT_APPEND_NEWLINE))
+    if stream is sys.stderr:
+        stream.buffer.flush()  # print() to stderr was line-buffered; keep errors immediate
+
+
+@functools.lru_cache(maxsize=1)
+def get_clickhouse():
+    """Get the shared ClickHouse client."""
+    client = clickhouse_connect.get_client(
+        host=os.environ.get("CLICKHOUSE_HOST", "localhost"),
+        port=int(os.environ.get("CLICKHOUSE_PORT", "8123")),
+        username=os.environ.get("CLICKHOUSE_USER", "default"),
+        password=os.environ.get("CLICKHOUSE_PASSWORD", ""),
+    )
+    atexit.register(client.close)
+    return client
+
+
+@functools.lru_cache(maxsize=1)
+def get_minio():
+    """Get the shared MinIO client (thread-safe, reused by all upload threads)."""
+    # Same settings as minio's default pool, but with one keep-alive connection
+    # per upload thread instead of the default 10
+    http_client = urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=300, read=300),
+        maxsize=MINIO_PUT_WORKERS,
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+    )
+
+    client = Minio(
+        MINIO_ENDPOINT,
+        access_key=MINIO_ACCESS_KEY,
+        secret_key=MINIO_SECRET_KEY,
+        secure=MINIO_SECURE,
+        http_client=http_client,
+    )
+
+    # Ensure bucket exists
+    if not client.bucket_exists(MINIO_BUCKET):
+        client.make_bucket(MINIO_BUCKET)
+        log("INFO", "Created MinIO bucket", bucket=MINIO_BUCKET)
+
+    return client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Get async HTTP/2 client with proper headers and a keep-alive connection pool."""
+    return httpx.AsyncClient(
+        timeout=30.0,
+        http2=True,
+        headers={"User-Agent": USER_AGENT},
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0),
+    )
+
+
+def ecli_to_path(ecli: str) -> str:
+    """Convert ECLI to MinIO path.
+
+    ECLI:NL:HR:2025:123 -> rechtspraak/NL/HR/2025/ECLI_NL_HR_2025_123.xml
+    """
+    parts = ecli.split(":")
+    safe_ecli = "_".join(parts)
+    if len(parts) >= 5:
+        return f"rechtspraak/{parts[1]}/{parts[2]}/{parts[3]}/{safe_ecli}.xml"
+    return f"rechtspraak/other/{safe_ecli}.xml"
@@ -9,75 +9,61 @@ Stores:
 - Raw XML files in MinIO
 """
 
+import asyncio
 import httpx
-import clickhouse_connect
-import json
+import multiprocessing
 import os
-import sys
-import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone, date
 from dateutil.relativedelta import relativedelta
 from io import BytesIO
+from typing import Iterator
 
+import zstandard
 from minio import Minio
 
+from .batcher import ASYNC_INSERT_SETTINGS, Batcher
+from .common import (
+    CONTENT_URL,
+    MINIO_BUCKET,
+    MINIO_PUT_WORKERS,
+    UITSPRAKEN_COLUMNS,
+    ZSTD_LEVEL,
+    ecli_to_path,
+    get_async_http_client,
+    get_clickhouse,
+    get_minio,
+    log,
+)
 from .parser import parse_sitemap, parse_uitspraak
+from .ratelimit import RateLimiter
 
 
 # Configuration
 SITEMAP_URL = "https://uitspraken.rechtspraak.nl/sitemap/UrlSet"
-CONTENT_URL = "https://data.rechtspraak.nl/uitspraken/content"
 REQUEST_DELAY = float(os.environ.get("REQUEST_DELAY", "1.0"))
 BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "100"))
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", "4"))
+# The job gets 500 MHz and 512 MB (odc-project.yml) and os.cpu_count() reports
+# host CPUs in a container. Each spawned worker re-imports this module with its
+# clients, and at ~1 req/s one process keeps up with parsing
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", "1"))
 START_YEAR = int(os.environ.get("START_YEAR", "2000"))
-USER_AGENT = "OpenDataCollection.com bot - Data zonder drempels (https://opendatacollection.com)"
-
-# MinIO configuration
-MINIO_ENDPOINT = os.environ.get("MINIO_ENDPOINT", "localhost:9002")
-MINIO_ACCESS_KEY = os.environ.get("MINIO_ACCESS_KEY", "minioadmin")
-MINIO_SECRET_KEY = os.environ.get("MINIO_SECRET_KEY", "minioadmin")
-MINIO_BUCKET = os.environ.get("MINIO_BUCKET", "raw-data")
-MINIO_SECURE = os.environ.get("MINIO_SECURE", "false").lower() == "true"
+SITEMAP_DELAY = float(os.environ.get("SITEMAP_DELAY", "0.5"))
+SITEMAP_CONCURRENCY = int(os.environ.get("SITEMAP_CONCURRENCY", "4"))
 STORE_XML = os.environ.get("STORE_XML", "true").lower() == "true"
 
+# Column types of rechtspraak_eclis as in schema.sql, in insert order
+ECLIS_COLUMNS = {
+    "ecli": "String",
+    "last_modified": "DateTime",
+    "source_url": "String",
+}
 
-def log(level: str, message: str, **extra):
-    """Structured JSON logging."""
-    entry = {
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "level": level,
-        "message": message,
-        "project": os.environ.get("PROJECT_NAME", "rechtspraak-scraper"),
-        **extra,
-    }
-    print(json.dumps(entry), file=sys.stderr if level == "ERROR" else sys.stdout)
-
-
-def get_clickhouse():
-    """Get ClickHouse client."""
-    return clickhouse_connect.get_client(
-        host=os.environ.get("CLICKHOUSE_HOST", "localhost"),
-        port=int(os.environ.get("CLICKHOUSE_PORT", "8123")),
-        username=os.environ.get("CLICKHOUSE_USER", "default"),
-        password=os.environ.get("CLICKHOUSE_PASSWORD", ""),
-    )
-
-
-def get_minio():
-    """Get MinIO client."""
-    client = Minio(
-        MINIO_ENDPOINT,
-        access_key=MINIO_ACCESS_KEY,
-        secret_key=MINIO_SECRET_KEY,
-        secure=MINIO_SECURE,
-    )
-
-    # Ensure bucket exists
-    if not client.bucket_exists(MINIO_BUCKET):
-        client.make_bucket(MINIO_BUCKET)
-        log("INFO", "Created MinIO bucket", bucket=MINIO_BUCKET)
-
-    return client
+# Phase 1 produces many small per-month inserts; give the server up to a
+# second to coalesce them into a single part
+INDEX_INSERT_SETTINGS = {**ASYNC_INSERT_SETTINGS, "async_insert_busy_timeout_ms": 1000}
 
 
 def generate_monthly_ranges(start_year: int) -> list[tuple[str, str]]:
@@ -94,87 +80,104 @@ def generate_monthly_ranges(start_year: int) -> list[tuple[str, str]]:
     return ranges
 
 
-def get_http_client() -> httpx.Client:
-    """Get HTTP client with proper headers."""
-    return httpx.Client(
-        timeout=30.0,
-        headers={"User-Agent": USER_AGENT},
-    )
+def get_rate_limiter(delay: float) -> RateLimiter:
+    """Get limiter allowing one request per delay seconds across all workers."""
+    return RateLimiter(1.0 / delay if delay > 0 else float("inf"))
 
 
-def fetch_sitemap(from_date: str, to_date: str) -> list[dict]:
-    """Fetch sitemap for a date range and return ECLI entries."""
+async def fetch_sitemap(
+    client: httpx.AsyncClient,
+    limiter: RateLimiter,
+    from_date: str,
+    to_date: str,
+) -> Iterator[dict] | None:
+    """Fetch sitemap for a date range and return its ECLI entries (parsed lazily), or None on failure."""
     url = f"{SITEMAP_URL}?from={from_date}&to={to_date}"
 
     try:
-        with get_http_client() as client:
-            resp = client.get(url)
-            resp.raise_for_status()
-            return parse_sitemap(resp.content)
+        await limiter.acquire()
+        resp = await client.get(url)
+        resp.raise_for_status()
     except httpx.HTTPError as e:
         log("ERROR", f"Failed to fetch sitemap", url=url, error=str(e))
-        return []
+        return None
 
+    return parse_sitemap(resp.content)
 
-def ecli_to_path(ecli: str) -> str:
-    """Convert ECLI to MinIO path.
 
-    ECLI:NL:HR:2025:123 -> rechtspraak/NL/HR/2025/ECLI_NL_HR_2025_123.xml
-    """
-    parts = ecli.split(":")
-    if len(parts) >= 5:
-        country = parts[1]
-        court = parts[2]
-        year = parts[3]
-        safe_ecli = ecli.replace(":", "_")
-        return f"rechtspraak/{country}/{court}/{year}/{safe_ecli}.xml"
-    else:
-        safe_ecli = ecli.replace(":", "_")
-        return f"rechtspraak/other/{safe_ecli}.xml"
+# Uploads (and their compression) run here so they overlap the next fetches
+_PUT_POOL = ThreadPoolExecutor(max_workers=MINIO_PUT_WORKERS, thread_name_prefix="minio-put")
+
+# ZstdCompressor instances are not thread-safe, so keep one per executor thread
+_zstd = threading.local()
+
+
+def compress_xml(xml_content: bytes) -> bytes:
+    """Compress XML with zstd for storage."""
+    compressor = getattr(_zstd, "compressor", None)
+    if compressor is None:
+        compressor = _zstd.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return compressor.compress(xml_content)
 
 
 def store_xml(minio_client: Minio, ecli: str, xml_content: bytes) -> str:
-    """Store XML content in MinIO. Returns the object path."""
-    path = ecli_to_path(ecli)
+    """Store zstd-compressed XML content in MinIO. Returns the object path."""
+    path = ecli_to_path(ecli) + ".zst"
+    compressed = compress_xml(xml_content)
 
     minio_client.put_object(
         MINIO_BUCKET,
         path,
-        BytesIO(xml_content),
-        len(xml_content),
-        content_type="application/xml",
+        BytesIO(compressed),
+        len(compressed),
+        content_type="application/zstd",
     )
 
     return path
 
 
-def fetch_uitspraak(ecli: str, minio_client: Minio = None) -> tuple[dict | None, str | None]:
+async def fetch_uitspraak(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    limiter: RateLimiter,
+    parse_pool: ProcessPoolExecutor,
+    ecli: str,
+    minio_client: Minio = None,
+) -> tuple[dict | None, str | None]:
     """Fetch and parse a single uitspraak by ECLI.
 
+    At most FETCH_CONCURRENCY requests are in flight (sem), and the shared
+    limiter keeps the overall request rate at one per REQUEST_DELAY. Parsing
+    runs in parse_pool so it neither holds the GIL of the event loop nor
+    waits for the MinIO upload.
+
     Returns (parsed_data, xml_path) where xml_path is the MinIO path if stored.
     """
     url = f"{CONTENT_URL}?id={ecli}"
     xml_path = None
 
     try:
-        with get_http_client() as client:
-            resp = client.get(url)
+        async with sem:
+            await limiter.acquire()
+            resp = await client.get(url)
             resp.raise_for_status()
             xml_content = resp.content
-
-            # Store raw XML in MinIO
-            if minio_client and STORE_XML:
-                try:
-                    xml_path = store_xml(minio_client, ecli, xml_content)
-                except Exception as e:
-                    log("ERROR", "Failed to store XML", ecli=ecli, error=str(e))
-
-            return parse_uitspraak(xml_content), xml_path
-
     except httpx.HTTPError as e:
         log("ERROR", f"Failed to fetch uitspraak", ecli=ecli, error=str(e))
         return None, None
 
+    loop = asyncio.get_running_loop()
+    parsed = loop.run_in_executor(parse_pool, parse_uitspraak, xml_content)
+
+    # Store raw XML in MinIO (blocking client, so off the event loop)
+    if minio_client and STORE_XML:
+        try:
+            xml_path = await loop.run_in_executor(_PUT_POOL, store_xml, minio_client, ecli, xml_content)
+        except Exception as e:
+            log("ERROR", "Failed to store XML", ecli=ecli, error=str(e))
+
+    return await parsed, xml_path
+
 
 def get_indexed_months(client) -> set[str]:
     """Get months that we've already indexed from the tracking table."""
@@ -185,12 +188,15 @@ def get_indexed_months(client) -> set[str]:
     return {row[0] for row in result.result_rows}
 
 
-def record_indexed_month(client, month: str, ecli_count: int):
-    """Record that we've indexed a sitemap month."""
+def record_indexed_months(client, months: list[tuple[str, int]]):
+    """Record that we've indexed sitemap months, given (month, ecli_count) pairs."""
+    if not months:
+        return
     client.insert(
         "rechtspraak_sitemap_months",
-        [(date.fromisoformat(month), ecli_count)],
+        [(date.fromisoformat(month), ecli_count) for month, ecli_count in months],
         column_names=["month", "ecli_count"],
+        settings=INDEX_INSERT_SETTINGS,
     )
 
 
@@ -215,104 +221,179 @@ def phase1_index(full_reindex: bool = False):
     # Always re-check last 2 months to catch new ECLIs
     recent_cutoff = date.today().replace(day=1) - relativedelta(months=2)
 
-    total_eclis = 0
-    skipped = 0
-    fetched = 0
+    # Skip if already indexed AND older than recent cutoff (unless full reindex)
+    months = [
+        (from_date, to_date)
+        for from_date, to_date in ranges
+        if full_reindex or from_date not in indexed_months or date.fromisoformat(from_date) >= recent_cutoff
+    ]
+    skipped = len(ranges) - len(months)
 
-    for i, (from_date, to_date) in enumerate(ranges):
-        month_date = date.fromisoformat(from_date)
+    total_eclis = asyncio.run(_index_months(client, months))
 
-        # Skip if already indexed AND older than recent cutoff (unless full reindex)
-        if not full_reindex and from_date in indexed_months and month_date < recent_cutoff:
-            skipped += 1
-            continue
-
-        entries = fetch_sitemap(from_date, to_date)
-        fetched += 1
+    log("INFO", f"Phase 1 complete", total_eclis=total_eclis, months_fetched=len(months), months_skipped=skipped)
+    return total_eclis
 
-        if entries:
-            # Prepare rows for insertion
-            rows = [
-                (
-                    e["ecli"],
-                    datetime.fromisoformat(e["lastmod"].replace("Z", "+00:00")) if e.get("lastmod") else datetime.now(timezone.utc),
-                    e["url"],
-                )
-                for e in entries
-            ]
 
-            client.insert(
-                "rechtspraak_eclis",
-                rows,
-                column_names=["ecli", "last_modified", "source_url"],
-            )
+async def _index_months(client, months: list[tuple[str, str]]) -> int:
+    """Fetch monthly sitemaps concurrently and stream their ECLIs into ClickHouse.
 
-            total_eclis += len(entries)
+    SITEMAP_CONCURRENCY workers take months from a shared iterator and hand
+    each fetched sitemap to a single consumer through a bounded queue. A
+    worker only starts its next fetch once the queue has taken the previous
+    one, so at most about 2 * SITEMAP_CONCURRENCY sitemaps are held in memory.
+    The consumer parses and inserts in a worker thread, so fetches continue
+    meanwhile. Returns the number of ECLIs indexed.
+    """
+    limiter = get_rate_limiter(SITEMAP_DELAY)  # Be gentle with sitemap requests
+    queue = asyncio.Queue(maxsize=SITEMAP_CONCURRENCY)
+    todo = iter(months)
+
+    async def produce(http_client: httpx.AsyncClient):
+        for from_date, to_date in todo:
+            entries = await fetch_sitemap(http_client, limiter, from_date, to_date)
+            await queue.put((from_date, entries))
+
+    async def produce_all(http_client: httpx.AsyncClient):
+        await asyncio.gather(*(produce(http_client) for _ in range(SITEMAP_CONCURRENCY)))
+        await queue.put(None)
+
+    # Months are only recorded once the insert of their ECLIs has returned, and
+    # the batcher waits for the server to write async inserts to a part, so a
+    # crash or failed insert never marks a month as indexed without its rows
+    unrecorded_months = []
+
+    def index_month(eclis: Batcher, from_date: str, entries: Iterator[dict]) -> int:
+        """Parse one sitemap into the batcher and flush if due (blocking). Returns its ECLI count."""
+        count = 0
+        now = datetime.now(timezone.utc)  # for entries without lastmod
+        for e in entries:
+            eclis.append((
+                e["ecli"],
+                datetime.fromisoformat(e["lastmod"].replace("Z", "+00:00")) if e.get("lastmod") else now,
+                e["url"],
+            ))
+            count += 1
 
         # Record that we've indexed this month (even if empty)
-        record_indexed_month(client, from_date, len(entries))
-        log("INFO", f"Indexed {from_date}", count=len(entries), progress=f"{fetched}/{len(ranges)-skipped}")
+        unrecorded_months.append((from_date, count))
+
+        flushed = eclis.maybe_flush()
+        if flushed:
+            log("INFO", "Inserted ECLIs", count=flushed)
+        if not eclis.size:
+            record_indexed_months(client, unrecorded_months)
+            unrecorded_months.clear()
+        return count
+
+    async def consume() -> int:
+        loop = asyncio.get_running_loop()
+        total_eclis = 0
+        done = 0
+
+        with Batcher(client, "rechtspraak_eclis", ECLIS_COLUMNS, settings=INDEX_INSERT_SETTINGS) as eclis:
+            while (item := await queue.get()) is not None:
+                from_date, entries = item
+                done += 1
+
+                # Failed fetches stay unrecorded so the next run retries them
+                if entries is None:
+                    continue
+
+                count = await loop.run_in_executor(None, index_month, eclis, from_date, entries)
+                total_eclis += count
+                log("INFO", f"Indexed {from_date}", count=count, progress=f"{done}/{len(months)}")
 
-        time.sleep(0.5)  # Be gentle with sitemap requests
+        record_indexed_months(client, unrecorded_months)
+        return total_eclis
+
+    async with get_async_http_client() as http_client:
+        _, total_eclis = await asyncio.gather(produce_all(http_client), consume())
 
-    log("INFO", f"Phase 1 complete", total_eclis=total_eclis, months_fetched=fetched, months_skipped=skipped)
     return total_eclis
 
 
 def phase2_fetch():
     """Phase 2: Fetch metadata for pending ECLIs."""
-    log("INFO", "Phase 2: Fetching pending uitspraken", store_xml=STORE_XML)
+    log("INFO", "Phase 2: Fetching pending uitspraken", store_xml=STORE_XML,
+        concurrency=FETCH_CONCURRENCY, parse_workers=PARSE_WORKERS)
+    asyncio.run(_phase2_async())
+
 
+async def _phase2_async():
+    """Fetch pending ECLIs batch by batch, with concurrent requests within a batch."""
     ch_client = get_clickhouse()
     minio_client = get_minio() if STORE_XML else None
 
-    while True:
-        # Get batch of pending ECLIs
-        pending = ch_client.query(
-            "SELECT ecli FROM rechtspraak_pending LIMIT {batch:UInt32}",
-            parameters={"batch": BATCH_SIZE},
-        )
-
-        if not pending.result_rows:
-            log("INFO", "No more pending ECLIs")
-            break
-
-        eclis = [row[0] for row in pending.result_rows]
-        log("INFO", f"Processing batch", count=len(eclis))
-
-        rows = []
-        for ecli in eclis:
-            data, xml_path = fetch_uitspraak(ecli, minio_client)
-            time.sleep(REQUEST_DELAY)
-
-            if data:
-                rows.append((
-                    data.get("ecli") or ecli,
-                    data.get("case_number"),
-                    data.get("decision_date"),
-                    data.get("publication_date"),
-                    data.get("court") or "Unknown",
-                    data.get("court_type") or "OTHER",
-                    data.get("procedure_type"),
-                    data.get("subject_area"),
-                    data.get("summary"),
-                    f"{CONTENT_URL}?id={ecli}",
-                    xml_path,  # New: store the MinIO path
-                    data.get("related_eclis") or [],
-                    datetime.now(timezone.utc),
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    limiter = get_rate_limiter(REQUEST_DELAY)
+
+    # spawn, not fork: the event loop and MinIO executor threads are already running
+    parse_pool = ProcessPoolExecutor(
+        max_workers=PARSE_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+    uitspraken = Batcher(ch_client, "rechtspraak_uitspraken", UITSPRAKEN_COLUMNS)
+
+    # Page through pending ECLIs by key: rows still buffered in the batcher (or
+    # ECLIs that failed to fetch) remain in the view and must not be re-selected
+    last_ecli = ""
+
+    with parse_pool, uitspraken:
+        async with get_async_http_client() as http_client:
+            while True:
+                # Get batch of pending ECLIs
+                pending = ch_client.query(
+                    """
+                    SELECT ecli FROM rechtspraak_pending
+                    WHERE ecli > {after:String}
+                    ORDER BY ecli
+                    LIMIT {batch:UInt32}
+                    """,
+                    parameters={"after": last_ecli, "batch": BATCH_SIZE},
+                )
+
+                if not pending.result_rows:
+                    log("INFO", "No more pending ECLIs")
+                    break
+
+                eclis = [row[0] for row in pending.result_rows]
+                last_ecli = eclis[-1]
+                log("INFO", f"Processing batch", count=len(eclis))
+
+                results = await asyncio.gather(*(
+                    fetch_uitspraak(http_client, sem, limiter, parse_pool, ecli, minio_client)
+                    for ecli in eclis
                 ))
 
-        if rows:
-            ch_client.insert(
-                "rechtspraak_uitspraken",
-                rows,
-                column_names=[
-                    "ecli", "case_number", "decision_date", "publication_date",
-                    "court", "court_type", "procedure_type", "subject_area",
-                    "summary", "content_url", "xml_path", "related_eclis", "scraped_at",
-                ],
-            )
-            log("INFO", f"Inserted batch", count=len(rows))
+                fetched = [
+                    (ecli, data, xml_path)
+                    for ecli, (data, xml_path) in zip(eclis, results)
+                    if data
+                ]
+                scraped_at = datetime.now(timezone.utc)
+
+                if fetched:
+                    uitspraken.extend_columns({
+                        "ecli": [data.get("ecli") or ecli for ecli, data, _ in fetched],
+                        "case_number": [data.get("case_number") for _, data, _ in fetched],
+                        "decision_date": [data.get("decision_date") for _, data, _ in fetched],
+                        "publication_date": [data.get("publication_date") for _, data, _ in fetched],
+                        "court": [data.get("court") or "Unknown" for _, data, _ in fetched],
+                        "court_type": [data.get("court_type") or "OTHER" for _, data, _ in fetched],
+                        "procedure_type": [data.get("procedure_type") for _, data, _ in fetched],
+                        "subject_area": [data.get("subject_area") for _, data, _ in fetched],
+                        "summary": [data.get("summary") for _, data, _ in fetched],
+                        "content_url": [f"{CONTENT_URL}?id={ecli}" for ecli, _, _ in fetched],
+                        "xml_path": [xml_path for _, _, xml_path in fetched],
+                        "related_eclis": [data.get("related_eclis") or [] for _, data, _ in fetched],
+                        "scraped_at": [scraped_at] * len(fetched),
+                    })
+
+                flushed = uitspraken.maybe_flush()
+                if flushed:
+                    log("INFO", f"Inserted batch", count=flushed)
 
 
 def main():
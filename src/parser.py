@@ -1,10 +1,13 @@
 """Parse rechtspraak.nl XML responses."""
 
 from lxml import etree
-from datetime import datetime
-from typing import Optional
+from datetime import date
+from io import BytesIO
+from typing import BinaryIO, Iterator, Optional
 import re
 
+import ciso8601
+
 # Namespaces used in rechtspraak XML
 NAMESPACES = {
     "dcterms": "http://purl.org/dc/terms/",
@@ -13,103 +16,136 @@ NAMESPACES = {
     "rs": "http://www.rechtspraak.nl/schema/rechtspraak-1.0",
 }
 
-
-def parse_sitemap(xml_content: bytes) -> list[dict]:
-    """Parse sitemap XML and extract ECLI identifiers with lastmod dates."""
-    root = etree.fromstring(xml_content)
-    ns = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
-
-    entries = []
-    for url in root.findall(".//sm:url", ns):
-        loc = url.findtext("sm:loc", namespaces=ns)
-        lastmod = url.findtext("sm:lastmod", namespaces=ns)
+# Clark-notation tags read by parse_uitspraak
+TAG_IDENTIFIER = f"{{{NAMESPACES['dcterms']}}}identifier"
+TAG_ECLI = f"{{{NAMESPACES['rs']}}}ecli"
+TAG_DATE = f"{{{NAMESPACES['dcterms']}}}date"
+TAG_DATUM = f"{{{NAMESPACES['rs']}}}datum"
+TAG_ISSUED = f"{{{NAMESPACES['dcterms']}}}issued"
+TAG_CREATOR = f"{{{NAMESPACES['dcterms']}}}creator"
+TAG_TYPE = f"{{{NAMESPACES['dcterms']}}}type"
+TAG_PROCEDURE = f"{{{NAMESPACES['psi']}}}procedure"
+TAG_SUBJECT = f"{{{NAMESPACES['dcterms']}}}subject"
+TAG_ZAAKNUMMER = f"{{{NAMESPACES['psi']}}}zaaknummer"
+TAG_INHOUDSINDICATIE = f"{{{NAMESPACES['rs']}}}inhoudsindicatie"
+TAG_RELATION = f"{{{NAMESPACES['dcterms']}}}relation"
+ATTR_RESOURCE = f"{{{NAMESPACES['rdf']}}}resource"
+
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+TAG_SM_URL = f"{{{SITEMAP_NS}}}url"
+TAG_SM_LOC = f"{{{SITEMAP_NS}}}loc"
+TAG_SM_LASTMOD = f"{{{SITEMAP_NS}}}lastmod"
+
+# ECLI from a URL like https://uitspraken.rechtspraak.nl/details?id=ECLI:NL:HR:2025:1
+ECLI_RE = re.compile(r"id=(ECLI:[^&]+)")
+
+# Court name fragments and the court type they map to
+COURT_TYPES = [
+    ("hoge raad", "HR"),
+    ("gerechtshof", "HOF"),
+    ("rechtbank", "RB"),
+    ("raad van state", "RVS"),
+    ("centrale raad van beroep", "CRVB"),
+    ("college van beroep", "CBB"),
+    ("raad voor de rechtspraak", "RVR"),
+]
+
+# One pass over the name instead of a substring scan per court type; the
+# named group that matched is the court type
+COURT_TYPE_RE = re.compile(
+    "|".join(f"(?P<{code}>{re.escape(fragment)})" for fragment, code in COURT_TYPES),
+    re.IGNORECASE,
+)
+
+UITSPRAAK_TAGS = (
+    TAG_IDENTIFIER, TAG_ECLI, TAG_DATE, TAG_DATUM, TAG_ISSUED, TAG_CREATOR,
+    TAG_TYPE, TAG_PROCEDURE, TAG_SUBJECT, TAG_ZAAKNUMMER, TAG_INHOUDSINDICATIE,
+    TAG_RELATION,
+)
+
+
+def parse_sitemap(xml_content: bytes | BinaryIO) -> Iterator[dict]:
+    """Parse sitemap XML and yield ECLI identifiers with lastmod dates.
+
+    Streams over the document and discards each <url> once read, so memory
+    does not grow with the number of entries.
+    """
+    source = BytesIO(xml_content) if isinstance(xml_content, bytes) else xml_content
+    for _, url in etree.iterparse(source, events=("end",), tag=TAG_SM_URL):
+        loc = None
+        lastmod = None
+        for child in url:
+            if child.tag == TAG_SM_LOC:
+                loc = child.text
+            elif child.tag == TAG_SM_LASTMOD:
+                lastmod = child.text
 
         if loc:
-            # Extract ECLI from URL like https://uitspraken.rechtspraak.nl/details?id=ECLI:NL:HR:2025:1
-            ecli_match = re.search(r"id=(ECLI:[^&]+)", loc)
+            ecli_match = ECLI_RE.search(loc)
             if ecli_match:
-                entries.append({
+                yield {
                     "ecli": ecli_match.group(1),
                     "lastmod": lastmod,
                     "url": loc,
-                })
+                }
 
-    return entries
+        # Free this entry and the already processed siblings the root still holds
+        url.clear()
+        while url.getprevious() is not None:
+            del url.getparent()[0]
 
 
 def parse_uitspraak(xml_content: bytes) -> Optional[dict]:
-    """Parse uitspraak XML content and extract structured data."""
+    """Parse uitspraak XML content and extract structured data.
+
+    Collects all fields in a single iterparse pass over UITSPRAAK_TAGS
+    instead of one tree search per field.
+    """
+    first_text = {}  # tag -> text of its first occurrence
+    case_number = None
+    summary = None
+    related = []
+
     try:
-        root = etree.fromstring(xml_content)
+        source = BytesIO(xml_content)
+        for _, elem in etree.iterparse(source, events=("end",), tag=UITSPRAAK_TAGS, collect_ids=False):
+            tag = elem.tag
+            if tag == TAG_RELATION:
+                ref = elem.get(ATTR_RESOURCE)
+                if ref and ref.startswith("ECLI:"):
+                    related.append(ref)
+            elif tag == TAG_ZAAKNUMMER:
+                if case_number is None and elem.text:
+                    case_number = elem.text
+            elif tag == TAG_INHOUDSINDICATIE:
+                if summary is None:
+                    summary = etree.tostring(elem, method="text", encoding="unicode").strip()
+            elif tag not in first_text:
+                first_text[tag] = elem.text or None
+            elem.clear()
     except etree.XMLSyntaxError:
         return None
 
-    def get_text(xpath: str) -> Optional[str]:
-        elem = root.find(xpath, NAMESPACES)
-        return elem.text if elem is not None and elem.text else None
-
-    def get_all_text(xpath: str) -> list[str]:
-        elems = root.findall(xpath, NAMESPACES)
-        return [e.text for e in elems if e.text]
+    def get_text(tag: str) -> Optional[str]:
+        return first_text.get(tag)
 
-    # Extract RDF metadata
-    rdf = root.find(".//rdf:Description", NAMESPACES)
-    if rdf is None:
-        rdf = root  # fallback
-
-    ecli = get_text(".//dcterms:identifier") or get_text(".//rs:ecli")
+    ecli = get_text(TAG_IDENTIFIER) or get_text(TAG_ECLI)
 
     # Parse dates
-    decision_date_str = get_text(".//dcterms:date") or get_text(".//rs:datum")
-    publication_date_str = get_text(".//dcterms:issued")
+    decision_date_str = get_text(TAG_DATE) or get_text(TAG_DATUM)
+    publication_date_str = get_text(TAG_ISSUED)
 
-    decision_date = None
-    if decision_date_str:
-        try:
-            decision_date = datetime.fromisoformat(decision_date_str.replace("Z", "+00:00")).date()
-        except ValueError:
-            try:
-                decision_date = datetime.strptime(decision_date_str[:10], "%Y-%m-%d").date()
-            except ValueError:
-                pass
-
-    publication_date = None
-    if publication_date_str:
-        try:
-            publication_date = datetime.fromisoformat(publication_date_str.replace("Z", "+00:00")).date()
-        except ValueError:
-            try:
-                publication_date = datetime.strptime(publication_date_str[:10], "%Y-%m-%d").date()
-            except ValueError:
-                pass
+    decision_date = parse_date(decision_date_str)
+    publication_date = parse_date(publication_date_str)
 
     # Court info
-    creator = get_text(".//dcterms:creator")
+    creator = get_text(TAG_CREATOR)
     court = creator or "Unknown"
     court_type = extract_court_type(court)
 
     # Classification
-    procedure = get_text(".//dcterms:type") or get_text(".//psi:procedure")
-    subject = get_text(".//dcterms:subject")
-
-    # Case number
-    case_number = None
-    case_nums = get_all_text(".//psi:zaaknummer")
-    if case_nums:
-        case_number = case_nums[0]
-
-    # Summary (inhoudsindicatie)
-    summary_elem = root.find(".//rs:inhoudsindicatie", NAMESPACES)
-    summary = None
-    if summary_elem is not None:
-        summary = etree.tostring(summary_elem, method="text", encoding="unicode").strip()
-
-    # Related ECLIs
-    related = []
-    for rel in root.findall(".//dcterms:relation", NAMESPACES):
-        ref = rel.get("{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource")
-        if ref and ref.startswith("ECLI:"):
-            related.append(ref)
+    procedure = get_text(TAG_TYPE) or get_text(TAG_PROCEDURE)
+    subject = get_text(TAG_SUBJECT)
 
     return {
         "ecli": ecli,
@@ -125,23 +161,21 @@ def parse_uitspraak(xml_content: bytes) -> Optional[dict]:
     }
 
 
+def parse_date(value: Optional[str]) -> Optional[date]:
+    """Parse an ISO 8601 date or datetime string to a date, None if malformed."""
+    if not value:
+        return None
+    try:
+        return ciso8601.parse_datetime(value).date()
+    except ValueError:
+        # Trailing garbage after the date part
+        try:
+            return ciso8601.parse_datetime(value[:10]).date()
+        except ValueError:
+            return None
+
+
 def extract_court_type(court_name: str) -> str:
     """Extract court type from court name."""
-    court_lower = court_name.lower()
-
-    if "hoge raad" in court_lower:
-        return "HR"
-    elif "gerechtshof" in court_lower:
-        return "HOF"
-    elif "rechtbank" in court_lower:
-        return "RB"
-    elif "raad van state" in court_lower:
-        return "RVS"
-    elif "centrale raad van beroep" in court_lower:
-        return "CRVB"
-    elif "college van beroep" in court_lower:
-        return "CBB"
-    elif "raad voor de rechtspraak" in court_lower:
-        return "RVR"
-    else:
-        return "OTHER"
+    match = COURT_TYPE_RE.search(court_name)
+    return match.lastgroup if match else "OTHER"
@@ -0,0 +1,25 @@
+"""Request pacing shared by concurrent fetchers."""
+
+import asyncio
+import time
+
+
+class RateLimiter:
+    """Allow at most `rate` acquisitions per second across all callers.
+
+    Keeps a cursor to the next free slot instead of sleeping after every
+    request: time spent waiting for a response counts towards the delay, so
+    throughput is the target rate rather than 1 / (delay + fetch time).
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+
+    async def acquire(self):
+        """Wait for the next free slot and claim it."""
+        now = time.monotonic()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)